@@ -1,14 +1,18 @@
 from __future__ import annotations
-import os, json, random, uuid, pathlib, html, mimetypes, tempfile, io
+import os, json, random, uuid, pathlib, html, mimetypes, tempfile, io, time, string, threading, sqlite3
+import shutil, subprocess, sys, gc, contextlib, base64, copy, logging, hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 import streamlit as st
 
 # ========================= קבועים והגדרות =========================
 APP_TITLE = "Quiz Media"
+log = logging.getLogger("quiz_media")
 DATA_DIR = pathlib.Path("data"); DATA_DIR.mkdir(parents=True, exist_ok=True)
 MEDIA_DIR = pathlib.Path("media"); MEDIA_DIR.mkdir(parents=True, exist_ok=True)
 LOCAL_QUESTIONS_JSON = DATA_DIR / "questions.json"
+LOCAL_QUESTIONS_SNAPSHOT = DATA_DIR / "questions.msgpack"
 
 ADMIN_CODE = os.getenv("ADMIN_CODE", "admin246")
 FIXED_N_QUESTIONS = 15
@@ -18,6 +22,40 @@ SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
 SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET", "")
 QUESTIONS_OBJECT_PATH = os.getenv("QUESTIONS_OBJECT_PATH", "data/questions.json")
+QUESTIONS_SNAPSHOT_PATH = os.getenv("QUESTIONS_SNAPSHOT_PATH", "data/questions.msgpack")
+
+# חדרים משותפים - SQLite אופציונלי (ריק = זיכרון בלבד)
+ROOMS_SQLITE_PATH = os.getenv("ROOMS_SQLITE_PATH", "")
+ROOM_POLL_SECONDS = 2
+ROOM_TTL_SECONDS = 6 * 3600
+ROOM_MAX_PLAYERS = 500
+
+# המרת וידאו/אודיו לפורמטים ידידותיים לדפדפן - רק אם ffmpeg זמין מקומית
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "1"))
+TRANSCODE_TIMEOUT_SECONDS = 600
+FFPROBE_BIN = os.getenv("FFPROBE_BIN", "ffprobe")
+
+# מגבלות קצב: פעולה -> (אסימונים לשנייה, גודל דלי). המפתח הוא הסשן, חוץ מכישלונות
+# התחברות - שם המפתח הוא כתובת הלקוח (סשן חדש לא מאפס אותם)
+RATE_LIMITS = {
+    "rerun": (4.0, 30),
+    "sign": (3.0, 80),          # עמוד התוצאות חותם את כל המדיה של המשחק בבת אחת
+    "upload": (0.2, 5),
+    "write": (0.5, 10),
+    "login": (0.2, 5),
+    "login_fail": (1 / 60, 10),      # כישלונות לכתובת לקוח
+    "login_fail_global": (0.1, 20),  # כישלונות מכל הכתובות יחד - נגד החלפת כתובות
+}
+EXPENSIVE_CONCURRENCY = int(os.getenv("EXPENSIVE_CONCURRENCY", "2"))
+EXPENSIVE_WAIT_SECONDS = 5
+LOGIN_BACKOFF_MAX_SECONDS = 300
+# פשרה מכוונת: כשמגבלת הכישלונות הגלובלית מוצתה, כל ההתחברויות נחסמות זמנית - גם של
+# המנהל האמיתי. כתובות ברשימה הזו (מופרדות בפסיקים) פטורות מהמגבלה הגלובלית בלבד.
+ADMIN_ALLOW_ADDRS = {a.strip() for a in os.getenv("ADMIN_ALLOW_ADDRS", "").split(",") if a.strip()}
+# כמה פרוקסים אמינים מוסיפים את עצמם ל-X-Forwarded-For (0 = לא סומכים על הכותרת)
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+BUSY_MSG = "השרת עמוס כרגע, נסו שוב בעוד רגע."
 
 def _supabase_on() -> bool:
     return bool(SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY and SUPABASE_BUCKET)
@@ -41,7 +79,104 @@ def show_flash():
 
 # ========================= ביצועים והגנות =========================
 st.set_page_config(page_title=APP_TITLE, page_icon="🎯", layout="wide")
+
+class BusyError(RuntimeError):
+    """חריגה ממגבלת קצב / אין מקום לפעולה כבדה - מוצג למשתמש כהודעת "עמוס"."""
+
+class RateLimiter:
+    """
+    Token bucket לכל (מפתח, פעולה) + תקרת מקביליות גלובלית לפעולות כבדות
+    (פענוח תמונות, כתיבת קבצים). משותף לכל הסשנים בתהליך.
+    """
+    def __init__(self, max_expensive: int):
+        self._lock = threading.Lock()
+        self._buckets: Dict[tuple[str, str], tuple[float, float]] = {}
+        self._expensive = threading.BoundedSemaphore(max(1, max_expensive))
+        self._penalties: Dict[str, tuple[int, float]] = {}  # מפתח -> (כישלונות, חסום עד)
+        self._last_prune = time.monotonic()
+
+    def _tokens(self, key: str, action: str, now: float) -> float:
+        rate, burst = RATE_LIMITS[action]
+        tokens, ts = self._buckets.get((key, action), (float(burst), now))
+        return min(float(burst), tokens + (now - ts) * rate)
+
+    def allow(self, key: str, action: str, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_prune > 60:
+                # דלי שלא נגעו בו מספיק זמן כבר מלא - אין טעם לשמור אותו
+                self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < 600}
+                self._penalties = {k: v for k, v in self._penalties.items() if now - v[1] < 3600}
+                self._last_prune = now
+            tokens = self._tokens(key, action, now)
+            ok = tokens >= cost
+            self._buckets[(key, action)] = (tokens - cost if ok else tokens, now)
+            return ok
+
+    def has_tokens(self, key: str, action: str) -> bool:
+        """בדיקה בלי לצרוך."""
+        with self._lock:
+            return self._tokens(key, action, time.monotonic()) >= 1.0
+
+    def penalty_left(self, key: str) -> float:
+        """שניות שנותרו להשהיה המעריכית של המפתח."""
+        with self._lock:
+            return max(0.0, self._penalties.get(key, (0, 0.0))[1] - time.monotonic())
+
+    def penalize(self, key: str, max_seconds: float) -> None:
+        """כישלון נוסף: 1, 2, 4... שניות עד max_seconds; שעה בלי כישלונות מאפסת."""
+        now = time.monotonic()
+        with self._lock:
+            fails, until = self._penalties.get(key, (0, 0.0))
+            if now - until > 3600:
+                fails = 0
+            self._penalties[key] = (fails + 1, now + min(max_seconds, 2 ** fails))
+
+    def forgive(self, key: str) -> None:
+        with self._lock:
+            self._penalties.pop(key, None)
+
+    @contextlib.contextmanager
+    def expensive(self, wait: Optional[float] = EXPENSIVE_WAIT_SECONDS):
+        """wait=None - ממתינים ללא הגבלה (לשימוש בעבודות רקע)."""
+        if not self._expensive.acquire(timeout=wait):
+            raise BusyError(BUSY_MSG)
+        try:
+            yield
+        finally:
+            self._expensive.release()
+
+@st.cache_resource(show_spinner=False)
+def _get_limiter() -> RateLimiter:
+    return RateLimiter(EXPENSIVE_CONCURRENCY)
+
+def _session_id() -> str:
+    """מזהה אנונימי יציב לסשן (לא נשמר מעבר לסשן)."""
+    if "_sid" not in st.session_state:
+        st.session_state["_sid"] = uuid.uuid4().hex
+    return st.session_state["_sid"]
+
+def _client_addr() -> str:
+    """כתובת הלקוח: מ-X-Forwarded-For מאחורי פרוקסי אמין, אחרת מהחיבור עצמו."""
+    ctx = getattr(st, "context", None)
+    headers = getattr(ctx, "headers", None) or {}
+    forwarded = [a.strip() for a in (headers.get("X-Forwarded-For") or "").split(",") if a.strip()]
+    if TRUSTED_PROXY_HOPS and forwarded:
+        # הרשומות מימין נכתבו ע"י הפרוקסים שלנו; משמאל להן - מה שהלקוח שלח (לא אמין)
+        return forwarded[-min(TRUSTED_PROXY_HOPS, len(forwarded))]
+    return getattr(ctx, "ip_address", None) or "unknown"
+
+def _rate_ok(action: str) -> bool:
+    return _get_limiter().allow(_session_id(), action)
+
+def _require_rate(action: str) -> None:
+    if not _rate_ok(action):
+        raise BusyError(BUSY_MSG)
+
 show_flash()
+if not _rate_ok("rerun"):
+    st.warning(BUSY_MSG)
+    st.stop()
 
 # ========================= CSS =========================
 st.markdown("""
@@ -111,6 +246,9 @@ label,p,li,.stMarkdown{text-align:right}
 /* מדיה */
 img{max-height:52vh;object-fit:contain}
 .video-shell,.audio-shell{width:100%}
+.media-box{width:100%;max-height:52vh;margin:0 auto;background:center/contain no-repeat}
+.media-box img{display:block;width:100%;height:100%;object-fit:contain}
+.video-shell{background:center/contain no-repeat}
 .video-shell video,.audio-shell audio{width:100%}
 </style>
 """, unsafe_allow_html=True)
@@ -183,29 +321,187 @@ def _upload_bytes_to_supabase(object_path: str, file_bytes: bytes, content_type:
     return _sburl(SUPABASE_BUCKET, object_path)
 
 def _save_uploaded_to_storage(upload) -> str:
-    """מעלה ל-Supabase אם מוגדר, אחרת שמירה מקומית. כולל HEIC→JPEG."""
+    """מעלה ל-Supabase אם מוגדר, אחרת שמירה מקומית. כולל HEIC→JPEG. BusyError אם עמוס."""
     if not upload:
         return ""
-    file_bytes, fixed_name, content_type = _ensure_jpeg_for_heic(upload)
-    if _supabase_on():
-        folder = datetime.utcnow().strftime("media/%Y/%m")
-        ext = pathlib.Path(fixed_name).suffix.lower()
-        object_path = f"{folder}/{uuid.uuid4().hex}{ext}"
-        return _upload_bytes_to_supabase(object_path, file_bytes, content_type)
-    # מקומי
-    class _Tmp:
-        name = fixed_name
-        def getbuffer(self): return file_bytes
-    return _save_uploaded_file_local(_Tmp())
+    _require_rate("upload")
+    with _get_limiter().expensive():  # פענוח HEIC + כתיבת הקובץ
+        file_bytes, fixed_name, content_type = _ensure_jpeg_for_heic(upload)
+        if _supabase_on():
+            folder = datetime.utcnow().strftime("media/%Y/%m")
+            ext = pathlib.Path(fixed_name).suffix.lower()
+            object_path = f"{folder}/{uuid.uuid4().hex}{ext}"
+            url = _upload_bytes_to_supabase(object_path, file_bytes, content_type)
+        else:
+            # מקומי
+            class _Tmp:
+                name = fixed_name
+                def getbuffer(self): return file_bytes
+            url = _save_uploaded_file_local(_Tmp())
+        _remember_media_meta(url, _probe_media(file_bytes, fixed_name, content_type))
+    # ffprobe/ffmpeg יכולים לקחת עשרות שניות - רצים ברקע, מחוץ לתקרת המקביליות
+    _queue_av_probe(url, file_bytes, fixed_name, content_type)
+    _queue_transcode(url, file_bytes, fixed_name, content_type)
+    return url
 
 def _signed_or_raw(url: str, seconds: int = 300) -> str:
+    """מחזיר "" אם הסשן חרג ממגבלת החתימות."""
     if url and url.startswith("sb://") and _supabase_on():
+        if not _rate_ok("sign"):
+            return ""
         return sign_url_sb(url, seconds)
     return url
 
+def _is_http_url(url: str) -> bool:
+    """רק כתובות כאלה הדפדפן יכול להביא מתוך HTML; נתיב מקומי צריך לעבור דרך st.image/st.audio."""
+    return url.startswith(("http://", "https://"))
+
+# ========================= Snapshot בינארי (msgpack, עמודות) =========================
+# פורמט קומפקטי לטעינה מהירה: עמודה לכל שדה, קטגוריות ממופות לאינדקס,
+# ונכונות התשובות כ-bitmask של 4 ביטים (בית לכל שאלה). JSON נשאר לייבוא/ייצוא ידני.
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_SCALARS = ("id", "type", "content_url", "question", "difficulty", "created_at")
+
+def _msgpack():
+    try:
+        import msgpack
+        return msgpack
+    except Exception:
+        return None
+
+def _is_valid_question(q: Any) -> bool:
+    return (isinstance(q, dict) and "question" in q and isinstance(q.get("answers"), list)
+            and len(q["answers"]) == 4 and all(isinstance(a, dict) for a in q["answers"]))
+
+def _encode_snapshot(all_q: List[Dict[str, Any]], json_md5: str = "") -> Optional[bytes]:
+    """json_md5 - חתימת קובץ ה-JSON שממנו נבנה ה-snapshot, לבדיקת טריות בקריאה."""
+    mp = _msgpack()
+    if mp is None:
+        return None
+    rows = [q for q in all_q if _is_valid_question(q)]
+    cats: Dict[str, int] = {}
+    cols: Dict[str, list] = {k: [] for k in _SNAPSHOT_SCALARS}
+    cols.update(answers=[], category=[], extra=[])
+    correct = bytearray()
+    known = set(_SNAPSHOT_SCALARS) | {"answers", "category"}
+    for q in rows:
+        for k in _SNAPSHOT_SCALARS:
+            cols[k].append(q.get(k))  # None בעמודה = שדה חסר
+        cols["answers"].append([a.get("text", "") for a in q["answers"]])
+        correct.append(sum(1 << j for j, a in enumerate(q["answers"]) if a.get("is_correct")))
+        cat = q.get("category")
+        cols["category"].append(cats.setdefault(cat, len(cats)) if isinstance(cat, str) else -1)
+        extra = {k: v for k, v in q.items() if k not in known}
+        extra.update({k: None for k in _SNAPSHOT_SCALARS if k in q and q[k] is None})  # null אמיתי
+        if "category" in q and not isinstance(cat, str):
+            extra["category"] = cat  # רק מחרוזות נכנסות לטבלת הקטגוריות
+        if any(set(a) - {"text", "is_correct"} for a in q["answers"]):
+            extra["answers"] = q["answers"]  # תשובות עם שדות נוספים - נשמרות כמו שהן
+        cols["extra"].append(extra or None)
+    return mp.packb({
+        "v": SNAPSHOT_VERSION, "validated": True, "n": len(rows), "json_md5": json_md5,
+        "cats": list(cats), "correct": bytes(correct), "cols": cols,
+    }, use_bin_type=True)
+
+def _decode_snapshot(blob: bytes, expect_json_md5: Optional[str] = None) -> Optional[List[Dict[str, Any]]]:
+    """
+    None = לא ניתן להשתמש (אין msgpack / גרסה אחרת / לא מאומת / JSON השתנה מאז) - חוזרים ל-JSON.
+    expect_json_md5 - אם נמסר, חייב להתאים לחתימה שנשמרה בזמן הכתיבה.
+    """
+    mp = _msgpack()
+    if mp is None:
+        return None
+    gc_was_on = gc.isenabled()
+    gc.disable()  # בניית עשרות אלפי dict-ים בלי סריקות GC באמצע
+    try:
+        d = mp.unpackb(blob, raw=False)
+        if d.get("v") != SNAPSHOT_VERSION or not d.get("validated"):
+            return None
+        if expect_json_md5 is not None and d.get("json_md5") != expect_json_md5:
+            return None
+        cols, n = d["cols"], d["n"]
+        # עמודות מלאות נבנות ב-zip אחד; עמודות חלקיות ממולאות רק איפה שיש ערך
+        full = [k for k in _SNAPSHOT_SCALARS if None not in cols[k]]
+        sparse = [k for k in _SNAPSHOT_SCALARS if k not in full]
+        out = [dict(zip(full, vals)) for vals in zip(*(cols[k] for k in full))] if full else [{} for _ in range(n)]
+        for k in sparse:
+            for q, v in zip(out, cols[k]):
+                if v is not None:
+                    q[k] = v
+        for q, (a0, a1, a2, a3), m in zip(out, cols["answers"], d["correct"]):
+            q["answers"] = [
+                {"text": a0, "is_correct": bool(m & 1)}, {"text": a1, "is_correct": bool(m & 2)},
+                {"text": a2, "is_correct": bool(m & 4)}, {"text": a3, "is_correct": bool(m & 8)},
+            ]
+        cats = [sys.intern(c) for c in d["cats"]]
+        for q, c in zip(out, cols["category"]):
+            if c >= 0:
+                q["category"] = cats[c]
+        for q, extra in zip(out, cols["extra"]):
+            if extra:
+                q.update(extra)
+        return out
+    finally:
+        if gc_was_on:
+            gc.enable()
+
+def _sb_object_etag(sb, object_path: str) -> Optional[str]:
+    """eTag של אובייקט ב-bucket (MD5 של התוכן בהעלאה רגילה) מתוך ה-metadata, בלי להוריד אותו."""
+    folder, _, name = object_path.rpartition("/")
+    for item in sb.storage.from_(SUPABASE_BUCKET).list(folder, {"search": name}) or []:
+        if item.get("name") == name:
+            etag = (item.get("metadata") or {}).get("eTag") or ""
+            return etag.strip('"') or None
+    return None
+
+def _read_snapshot() -> Optional[List[Dict[str, Any]]]:
+    if _msgpack() is None:
+        return None
+    try:
+        # JSON שנערך/יובא ידנית אחרי ה-snapshot גובר
+        if _supabase_on():
+            # הורדת ה-snapshot ובדיקת ה-eTag של ה-JSON במקביל - סבב רשת אחד בפועל
+            sb = _get_supabase(); assert sb is not None
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                blob_f = ex.submit(sb.storage.from_(SUPABASE_BUCKET).download, QUESTIONS_SNAPSHOT_PATH)
+                etag_f = ex.submit(_sb_object_etag, sb, QUESTIONS_OBJECT_PATH)
+                blob, etag = blob_f.result(), etag_f.result()
+            if etag is None:  # אין חתימה להשוואה (או eTag מרובה-חלקים) - בטוח יותר לקרוא JSON
+                return None
+            return _decode_snapshot(blob, expect_json_md5=etag)
+        else:
+            if not LOCAL_QUESTIONS_SNAPSHOT.exists():
+                return None
+            if LOCAL_QUESTIONS_JSON.exists() and LOCAL_QUESTIONS_JSON.stat().st_mtime > LOCAL_QUESTIONS_SNAPSHOT.stat().st_mtime:
+                return None
+            blob = LOCAL_QUESTIONS_SNAPSHOT.read_bytes()
+        return _decode_snapshot(blob)
+    except Exception:
+        return None
+
+def _write_snapshot(all_q: List[Dict[str, Any]], json_payload: bytes) -> None:
+    """נכתב אחרי ה-JSON. אם נכשל (כולל הקידוד) - מוחקים snapshot ישן כדי שלא יוגש מידע מיושן."""
+    try:
+        blob = _encode_snapshot(all_q, json_md5=hashlib.md5(json_payload, usedforsecurity=False).hexdigest())
+        if blob is None:
+            return
+        if _supabase_on():
+            _upload_bytes_to_supabase(QUESTIONS_SNAPSHOT_PATH, blob, "application/x-msgpack")
+        else:
+            LOCAL_QUESTIONS_SNAPSHOT.write_bytes(blob)
+    except Exception:
+        if _supabase_on():
+            sb = _get_supabase(); assert sb is not None
+            sb.storage.from_(SUPABASE_BUCKET).remove([QUESTIONS_SNAPSHOT_PATH])
+        else:
+            LOCAL_QUESTIONS_SNAPSHOT.unlink(missing_ok=True)
+
 # ========================= DB: קריאה/כתיבה עם cache =========================
 @st.cache_data(ttl=60, show_spinner=False)
 def _read_questions_cached() -> List[Dict[str, Any]]:
+    snap = _read_snapshot()
+    if snap is not None:
+        return snap  # כבר מאומת בזמן הכתיבה
     if _supabase_on():
         try:
             sb = _get_supabase(); assert sb is not None
@@ -218,30 +514,261 @@ def _read_questions_cached() -> List[Dict[str, Any]]:
             LOCAL_QUESTIONS_JSON.write_text("[]", encoding="utf-8")
         data = json.loads(LOCAL_QUESTIONS_JSON.read_text(encoding="utf-8"))
 
-    clean = []
-    for q in data:
-        if isinstance(q, dict) and "question" in q and isinstance(q.get("answers"), list) and len(q["answers"]) == 4:
-            clean.append(q)
-    return clean
+    return [q for q in data if _is_valid_question(q)]
 
-def _write_questions(all_q: List[Dict[str, Any]]) -> None:
-    """כותב JSON ומנקה cache לקריאה מהירה."""
-    payload = json.dumps(all_q, ensure_ascii=False, indent=2).encode("utf-8")
-    if _supabase_on():
-        sb = _get_supabase(); assert sb is not None
-        file_options = {"contentType": "application/json; charset=utf-8", "upsert": "true"}
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".json") as tmp:
-            tmp.write(payload)
-            tmp_path = tmp.name
-        try:
-            sb.storage.from_(SUPABASE_BUCKET).upload(QUESTIONS_OBJECT_PATH, tmp_path, file_options=file_options)
-        finally:
-            try: os.remove(tmp_path)
-            except Exception: pass
-    else:
-        LOCAL_QUESTIONS_JSON.write_bytes(payload)
+def _write_questions(all_q: List[Dict[str, Any]], busy_wait: Optional[float] = EXPENSIVE_WAIT_SECONDS) -> None:
+    """כותב JSON + snapshot בינארי ומנקה cache לקריאה מהירה. BusyError אם אין מקום תוך busy_wait."""
+    with _get_limiter().expensive(busy_wait):
+        payload = json.dumps(all_q, ensure_ascii=False, indent=2).encode("utf-8")
+        if _supabase_on():
+            sb = _get_supabase(); assert sb is not None
+            file_options = {"contentType": "application/json; charset=utf-8", "upsert": "true"}
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".json") as tmp:
+                tmp.write(payload)
+                tmp_path = tmp.name
+            try:
+                sb.storage.from_(SUPABASE_BUCKET).upload(QUESTIONS_OBJECT_PATH, tmp_path, file_options=file_options)
+            finally:
+                try: os.remove(tmp_path)
+                except Exception: pass
+        else:
+            LOCAL_QUESTIONS_JSON.write_bytes(payload)
+        _write_snapshot(all_q, payload)
     _read_questions_cached.clear()
 
+@st.cache_resource(show_spinner=False)
+def _get_bank_lock() -> threading.Lock:
+    return threading.Lock()
+
+@contextlib.contextmanager
+def _bank_write(wait: Optional[float] = EXPENSIVE_WAIT_SECONDS):
+    """
+    נעילה אחת לתהליך סביב קריאה→שינוי→כתיבה של המאגר (אדמין + עבודות רקע),
+    כדי שכותב אחד לא ידרוס שינוי של אחר. wait=None - ממתינים ללא הגבלה.
+    """
+    lock = _get_bank_lock()
+    if not lock.acquire(timeout=-1 if wait is None else wait):
+        raise BusyError(BUSY_MSG)
+    try:
+        yield
+    finally:
+        lock.release()
+
+# ========================= המרות מדיה ברקע (ffmpeg) =========================
+# לכל רנדישן: (סיומת, content-type, ארגומנטים ל-ffmpeg בין הקלט לפלט)
+_VIDEO_RENDITIONS = {
+    "video": (".web.mp4", "video/mp4", [
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-c:v", "libx264", "-preset", "veryfast", "-profile:v", "high", "-pix_fmt", "yuv420p",
+        "-vf", "scale='min(1280,iw)':-2", "-crf", "23", "-maxrate", "2M", "-bufsize", "4M",
+        "-c:a", "aac", "-b:a", "96k", "-ac", "2", "-movflags", "+faststart",
+    ]),
+    "poster": (".poster.jpg", "image/jpeg", [
+        "-frames:v", "1", "-vf", "thumbnail,scale='min(1280,iw)':-2", "-q:v", "4",
+    ]),
+}
+_AUDIO_RENDITIONS = {
+    "audio_opus": (".web.webm", "audio/webm", ["-vn", "-c:a", "libopus", "-b:a", "64k"]),
+    "audio_aac": (".web.m4a", "audio/mp4", ["-vn", "-c:a", "aac", "-b:a", "96k", "-ac", "2", "-movflags", "+faststart"]),
+}
+
+def _ffmpeg_path() -> Optional[str]:
+    return shutil.which(FFMPEG_BIN)
+
+@st.cache_resource(show_spinner=False)
+def _get_transcoder() -> Dict[str, Any]:
+    """תור רקע משותף: pool ותוצאות (רנדישנים / מטא-דאטה) לפי URL מקורי."""
+    return {
+        "pool": ThreadPoolExecutor(max_workers=max(1, TRANSCODE_WORKERS), thread_name_prefix="transcode"),
+        "done": {},
+        "meta": {},  # מטא-דאטה של אודיו/וידאו שנאספה ברקע
+        "lock": threading.Lock(),  # מגן על done בלבד; המאגר עצמו - _bank_write
+    }
+
+def _rendition_url(original_url: str, suffix: str, file_bytes: bytes, content_type: str) -> str:
+    """שומר רנדישן ליד הקובץ המקורי (אותו bucket/תיקייה)."""
+    if original_url.startswith("sb://"):
+        _, path = _split_sburl(original_url)
+        object_path = str(pathlib.PurePosixPath(path).with_suffix("")) + suffix
+        return _upload_bytes_to_supabase(object_path, file_bytes, content_type)
+    path = pathlib.Path(original_url).with_suffix("")
+    out = path.parent / (path.name + suffix)
+    out.write_bytes(file_bytes)
+    return str(out).replace("\\", "/")
+
+def _transcode_job(original_url: str, file_bytes: bytes, ext: str, specs: Dict[str, tuple]) -> None:
+    ffmpeg = _ffmpeg_path()
+    if not ffmpeg:
+        return
+    renditions: Dict[str, str] = {}
+    with tempfile.TemporaryDirectory(prefix="transcode_") as tmp:
+        src = pathlib.Path(tmp) / f"src{ext}"
+        src.write_bytes(file_bytes)
+        for name, (suffix, content_type, args) in specs.items():
+            dst = pathlib.Path(tmp) / f"{name}{suffix}"
+            try:
+                subprocess.run([ffmpeg, "-hide_banner", "-loglevel", "error", "-y", "-i", str(src), *args, str(dst)],
+                               check=True, timeout=TRANSCODE_TIMEOUT_SECONDS,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                renditions[name] = _rendition_url(original_url, suffix, dst.read_bytes(), content_type)
+            except subprocess.CalledProcessError as e:
+                # רנדישן שנכשל - נשתמש במקור, אבל משאירים עקבות
+                stderr = (e.stderr or b"").decode("utf-8", "replace").strip()[-500:]
+                log.warning("transcode %s failed for %s (exit %s): %s", name, original_url, e.returncode, stderr)
+            except Exception:
+                log.exception("transcode %s failed for %s", name, original_url)
+    if renditions:
+        _attach_renditions(original_url, renditions)
+
+def _patch_questions_for_url(url: str, field: str, value: Dict[str, Any], merge: bool = False) -> None:
+    """מעדכן שדה בשאלות שכבר נשמרו עם ה-URL הזה (מעבודות רקע)."""
+    with _bank_write(wait=None):
+        _read_questions_cached.clear()
+        all_q = _read_questions_cached()
+        changed = False
+        for q in all_q:
+            if q.get("content_url") != url:
+                continue
+            new_val = {**(q.get(field) or {}), **value} if merge else value
+            if q.get(field) != new_val:
+                q[field] = new_val
+                changed = True
+        if changed:
+            _write_questions(all_q, busy_wait=None)
+
+def _attach_renditions(original_url: str, renditions: Dict[str, str]) -> None:
+    """רושם תוצאה ומעדכן שאלות שכבר נשמרו עם ה-URL הזה."""
+    tc = _get_transcoder()
+    with tc["lock"]:
+        tc["done"][original_url] = renditions
+    _patch_questions_for_url(original_url, "renditions", renditions)
+
+def _submit_background(fn, *args) -> None:
+    """מריץ על pool הרקע; חריגה שלא נתפסה נרשמת ללוג במקום להיעלם ב-future."""
+    def _report(fut):
+        exc = fut.exception()
+        if exc is not None:
+            log.error("background job %s failed", fn.__name__, exc_info=exc)
+    _get_transcoder()["pool"].submit(fn, *args).add_done_callback(_report)
+
+def _queue_transcode(url: str, file_bytes: bytes, name: str, content_type: str) -> None:
+    """מכניס לתור המרה לאודיו/וידאו. אין ffmpeg - אין המרה, המקור מוגש כמו שהוא."""
+    if not url or not _ffmpeg_path():
+        return
+    if content_type.startswith("video/"):
+        specs = _VIDEO_RENDITIONS
+    elif content_type.startswith("audio/"):
+        specs = _AUDIO_RENDITIONS
+    else:
+        return
+    ext = pathlib.Path(name).suffix.lower()
+    _submit_background(_transcode_job, url, file_bytes, ext, specs)
+
+def _renditions_for(url: str) -> Dict[str, str]:
+    """רנדישנים שכבר מוכנים ל-URL (אם ההמרה עוד רצה - יתווספו אוטומטית בסיומה)."""
+    return dict(_get_transcoder()["done"].get(url, {})) if url else {}
+
+# ========================= מטא-דאטה של מדיה (בזמן העלאה) =========================
+# נשמר על השאלה תחת "media": width/height/duration/bytes/mime/placeholder,
+# כדי שהדף ישמור מקום ויציג placeholder מטושטש בלי לחכות להורדת הקובץ.
+PLACEHOLDER_PX = 16
+
+def _placeholder_data_uri(im) -> str:
+    """תמונה זעירה ומטושטשת כ-data URI (כמה מאות בתים)."""
+    from PIL import ImageFilter
+    im = im.convert("RGB")
+    im.thumbnail((PLACEHOLDER_PX, PLACEHOLDER_PX))
+    im = im.filter(ImageFilter.GaussianBlur(1))
+    out = io.BytesIO()
+    im.save(out, format="JPEG", quality=50)
+    return "data:image/jpeg;base64," + base64.b64encode(out.getvalue()).decode("ascii")
+
+def _probe_image(file_bytes: bytes) -> Dict[str, Any]:
+    from PIL import Image, ImageOps
+    im = ImageOps.exif_transpose(Image.open(io.BytesIO(file_bytes)))  # מידות כפי שיוצגו בפועל
+    return {"width": im.width, "height": im.height, "placeholder": _placeholder_data_uri(im)}
+
+def _probe_av(file_bytes: bytes, ext: str) -> Dict[str, Any]:
+    """ffprobe למידות/משך, ו-ffmpeg לפריים placeholder (וידאו). בלי הכלים - מחזיר {}."""
+    ffprobe = shutil.which(FFPROBE_BIN)
+    if not ffprobe:
+        return {}
+    meta: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory(prefix="probe_") as tmp:
+        src = pathlib.Path(tmp) / f"src{ext}"
+        src.write_bytes(file_bytes)
+        res = subprocess.run([ffprobe, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", str(src)],
+                             check=True, capture_output=True, timeout=30)
+        info = json.loads(res.stdout or b"{}")
+        duration = (info.get("format") or {}).get("duration")
+        if duration:
+            meta["duration"] = round(float(duration), 2)
+        video = next((x for x in info.get("streams", []) if x.get("codec_type") == "video"), None)
+        if video and video.get("width") and video.get("height"):
+            w, h = int(video["width"]), int(video["height"])
+            rotation = int((video.get("tags") or {}).get("rotate", 0) or 0)
+            for sd in video.get("side_data_list", []):
+                rotation = int(sd.get("rotation", rotation) or rotation)
+            if abs(rotation) % 180 == 90:  # צילום אנכי מאייפון
+                w, h = h, w
+            meta.update(width=w, height=h)
+            ffmpeg = _ffmpeg_path()
+            if ffmpeg:
+                try:  # placeholder הוא תוספת - כישלון כאן לא מבטל מידות/משך
+                    frame = subprocess.run([ffmpeg, "-v", "error", "-i", str(src), "-frames:v", "1",
+                                            "-vf", "scale=64:-2", "-f", "image2pipe", "-vcodec", "mjpeg", "-"],
+                                           check=True, capture_output=True, timeout=30).stdout
+                    from PIL import Image
+                    meta["placeholder"] = _placeholder_data_uri(Image.open(io.BytesIO(frame)))
+                except Exception:
+                    pass
+    return meta
+
+def _probe_media(file_bytes: bytes, name: str, content_type: str) -> Dict[str, Any]:
+    """בדיקה מהירה בזמן ההעלאה: תמיד bytes/mime, ולתמונות גם מידות+placeholder. אודיו/וידאו - ברקע."""
+    meta: Dict[str, Any] = {"bytes": len(file_bytes), "mime": content_type}
+    try:
+        if content_type.startswith("image/"):
+            meta.update(_probe_image(file_bytes))
+    except Exception:
+        log.warning("image probe failed for %s", name, exc_info=True)
+    return meta
+
+def _probe_av_job(url: str, file_bytes: bytes, ext: str) -> None:
+    meta = _probe_av(file_bytes, ext)
+    if not meta:
+        return
+    tc = _get_transcoder()
+    with tc["lock"]:
+        tc["meta"][url] = meta
+    _patch_questions_for_url(url, "media", meta, merge=True)
+
+def _queue_av_probe(url: str, file_bytes: bytes, name: str, content_type: str) -> None:
+    if url and content_type.startswith(("video/", "audio/")) and shutil.which(FFPROBE_BIN):
+        _submit_background(_probe_av_job, url, file_bytes, pathlib.Path(name).suffix.lower())
+
+def _remember_media_meta(url: str, meta: Dict[str, Any]) -> None:
+    """ההעלאה קורית לפני השמירה - שומרים בסשן עד שהשאלה נכתבת."""
+    st.session_state.setdefault("_media_meta", {})[url] = meta
+
+def _media_meta_for(url: str) -> Dict[str, Any]:
+    """מה שנאסף בהעלאה + מה שהבדיקה ברקע כבר סיימה (אם לא - תתווסף בסיומה)."""
+    if not url:
+        return {}
+    return {**st.session_state.get("_media_meta", {}).get(url, {}), **_get_transcoder()["meta"].get(url, {})}
+
+def _media_summary(q: Dict[str, Any]) -> str:
+    """תקציר למסכי אדמין, בלי להוריד את הקובץ."""
+    m = q.get("media") or {}
+    parts = []
+    if m.get("width") and m.get("height"):
+        parts.append(f"{m['width']}×{m['height']}")
+    if m.get("duration"):
+        parts.append(f"{m['duration']:.1f} שנ'")
+    if m.get("bytes"):
+        parts.append(f"{m['bytes'] / 1_048_576:.1f}MB" if m["bytes"] >= 1_048_576 else f"{m['bytes'] // 1024}KB")
+    return " | ".join(parts)
+
 # ========================= Utilities =========================
 def reset_admin_state():
     for k in ["admin_mode","admin_screen","admin_edit_mode","admin_edit_qid"]:
@@ -255,13 +782,19 @@ def _next_game_run():
     """מגדיל מזהה ריצה כדי לאפס את מפתחות הווידג'טים של התשובות."""
     st.session_state["game_run"] = st.session_state.get("game_run", 0) + 1
 
-def ensure_game_loaded():
+def _draw_deck() -> List[Dict[str, Any]]:
+    """מגריל חפיסת שאלות (עם ערבוב תשובות) מתוך המאגר."""
+    qs = _read_questions_cached()
+    k = min(FIXED_N_QUESTIONS, len(qs))
+    chosen = random.sample(qs, k=k) if k > 0 else []
+    for q in chosen:
+        random.shuffle(q["answers"])
+    return chosen
+
+def ensure_game_loaded(deck: Optional[List[Dict[str, Any]]] = None):
+    """טוען משחק לסשן. אם הועברה חפיסה (למשל מחדר משותף) - משתמשים בה במקום הגרלה."""
     if "questions" not in st.session_state:
-        qs = _read_questions_cached()
-        k = min(FIXED_N_QUESTIONS, len(qs))
-        chosen = random.sample(qs, k=k) if k > 0 else []
-        for q in chosen:
-            random.shuffle(q["answers"])
+        chosen = deck if deck is not None else _draw_deck()
         st.session_state.questions = chosen
         st.session_state.current_idx = 0
         st.session_state.answers_map = {}
@@ -279,27 +812,293 @@ def _calc_score(questions: List[Dict[str, Any]], answers_map: Dict[int, str]) ->
             score += 1
     return score
 
+# ========================= חדרים משותפים (מארח + שחקנים) =========================
+class RoomStore:
+    """
+    מאגר מצב חדרים משותף לכל הסשנים בתהליך. נעילה אחת, מונה גרסה לכל חדר.
+    הגרסה עולה רק כשמצב ה"זרם" משתנה (התחלה/שאלה הבאה/סיום) - תשובות שחקנים
+    לא מקפיצות אותה, כדי שמאות שחקנים לא יגרמו זה לזה לרענונים.
+    SQLite אופציונלי: כתיבה-דרך, שרידות לאתחול ושיתוף בין תהליכים - כל שינוי
+    רץ בטרנזקציית BEGIN IMMEDIATE וטוען את החדר מחדש בתוכה, כך שתהליכים לא דורסים זה את זה.
+    """
+    def __init__(self, sqlite_path: str = ""):
+        self._lock = threading.Lock()
+        self._rooms: Dict[str, Dict[str, Any]] = {}
+        self._db = None
+        if sqlite_path:
+            # isolation_level=None - הטרנזקציות מנוהלות ידנית ב-_txn
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS rooms (code TEXT PRIMARY KEY, version INTEGER, updated REAL, data TEXT)"
+            )
+
+    @contextlib.contextmanager
+    def _txn(self):
+        """נעילה בתהליך + נעילת כתיבה ב-SQLite לכל אורך קריאה→שינוי→כתיבה."""
+        with self._lock:
+            if self._db is None:
+                yield
+                return
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                self._rooms.clear()  # ייתכן ששונו עותקים בזיכרון שלא נכתבו
+                raise
+            self._db.execute("COMMIT")
+
+    # ----- פנימי (נקרא תחת נעילה / בתוך _txn) -----
+    def _load(self, code: str) -> Optional[Dict[str, Any]]:
+        room = self._rooms.get(code)
+        if self._db is None:
+            return room
+        # SQLite הוא מקור האמת; הזיכרון משמש cache לפי חותמת העדכון
+        row = self._db.execute("SELECT updated FROM rooms WHERE code=?", (code,)).fetchone()
+        if row is None:
+            return None
+        if room is None or room["updated"] != row[0]:
+            data = self._db.execute("SELECT data FROM rooms WHERE code=?", (code,)).fetchone()[0]
+            room = json.loads(data)
+            self._rooms[code] = room
+        return room
+
+    def _save(self, room: Dict[str, Any], bump: bool) -> None:
+        if bump:
+            room["version"] += 1
+        room["updated"] = time.time()
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO rooms (code, version, updated, data) VALUES (?,?,?,?)",
+                (room["code"], room["version"], room["updated"], json.dumps(room, ensure_ascii=False)),
+            )
+
+    def _expire(self) -> None:
+        cutoff = time.time() - ROOM_TTL_SECONDS
+        for code in [c for c, r in self._rooms.items() if r["updated"] < cutoff]:
+            self._rooms.pop(code, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM rooms WHERE updated < ?", (cutoff,))
+
+    # ----- API -----
+    def create(self, host_id: str, deck: List[Dict[str, Any]]) -> str:
+        with self._txn():
+            self._expire()
+            while True:
+                code = "".join(random.choices(string.ascii_uppercase + string.digits, k=5))
+                if self._load(code) is None:
+                    break
+            room = {
+                "code": code, "host": host_id, "deck": deck, "status": "lobby",
+                "current_idx": 0, "version": 0, "updated": 0.0, "players": {},
+            }
+            self._rooms[code] = room
+            self._save(room, bump=False)
+            return code
+
+    def get(self, code: str) -> Optional[Dict[str, Any]]:
+        """עותק שנלקח תחת הנעילה - אף סשן לא מחזיק הפניה למצב המשותף."""
+        with self._lock:
+            room = self._load(code)
+            if room is None:
+                return None
+            snap = {k: v for k, v in room.items() if k not in ("players", "deck")}
+            snap["players"] = {pid: {**p, "answers": dict(p["answers"])} for pid, p in room["players"].items()}
+            snap["deck"] = copy.deepcopy(room["deck"])
+            return snap
+
+    def version(self, code: str) -> int:
+        """בדיקה זולה לפולינג - בלי להעתיק את החדר."""
+        with self._lock:
+            if self._db is not None:
+                row = self._db.execute("SELECT version FROM rooms WHERE code=?", (code,)).fetchone()
+                return row[0] if row else -1
+            room = self._rooms.get(code)
+            return room["version"] if room else -1
+
+    def join(self, code: str, player_id: str, name: str) -> bool:
+        with self._txn():
+            room = self._load(code)
+            if room is None or room["status"] == "ended" or len(room["players"]) >= ROOM_MAX_PLAYERS:
+                return False
+            room["players"].setdefault(player_id, {"name": name, "answers": {}, "score": 0})
+            self._save(room, bump=False)
+            return True
+
+    def answer(self, code: str, player_id: str, q_index: int, picked: str) -> bool:
+        """תשובה אחת לכל שאלה, ורק לשאלה הפעילה."""
+        with self._txn():
+            room = self._load(code)
+            if room is None or room["status"] != "question" or room["current_idx"] != q_index:
+                return False
+            p = room["players"].get(player_id)
+            key = str(q_index)  # מפתחות מחרוזת - כדי לשרוד סבב JSON
+            if p is None or key in p["answers"]:
+                return False
+            p["answers"][key] = picked
+            q = room["deck"][q_index]
+            if any(a["text"] == picked and a.get("is_correct") for a in q["answers"]):
+                p["score"] += 1
+            self._save(room, bump=False)
+            return True
+
+    def advance(self, code: str, host_id: str) -> None:
+        """lobby → שאלה 1 → ... → ended."""
+        with self._txn():
+            room = self._load(code)
+            if room is None or room["host"] != host_id or room["status"] == "ended":
+                return
+            if room["status"] == "lobby":
+                room["status"] = "question"
+            elif room["current_idx"] + 1 >= len(room["deck"]):
+                room["status"] = "ended"
+            else:
+                room["current_idx"] += 1
+            self._save(room, bump=True)
+
+    def close(self, code: str, host_id: str) -> None:
+        with self._txn():
+            room = self._load(code)
+            if room is None or room["host"] != host_id:
+                return
+            room["status"] = "ended"
+            self._save(room, bump=True)
+
+    def leaderboard(self, code: str) -> List[tuple[str, int, int]]:
+        """(שם, ניקוד, מס' תשובות) ממוין - כל השחקנים."""
+        with self._lock:
+            room = self._load(code)
+            if room is None:
+                return []
+            rows = [(p["name"], p["score"], len(p["answers"])) for p in room["players"].values()]
+        rows.sort(key=lambda r: (-r[1], r[0]))
+        return rows
+
+@st.cache_resource(show_spinner=False)
+def _get_room_store() -> RoomStore:
+    return RoomStore(ROOMS_SQLITE_PATH)
+
+def _room_token() -> str:
+    """סוד החדר של הסשן: טוקן מארח או מזהה שחקן."""
+    return st.session_state.get("room_token", "")
+
+def _enter_room(code: str, role: str, token: str):
+    """
+    נכנסים לחדר ושומרים קוד+טוקן גם ב-URL - רענון דף / ניתוק websocket יוצרים
+    סשן חדש, ובלי זה המארח מאבד שליטה והשחקן את הניקוד.
+    """
+    st.session_state["room_code"] = code
+    st.session_state["room_role"] = role
+    st.session_state["room_token"] = token
+    st.query_params.update({"room": code, "role": role, "rt": token})
+    st.session_state.phase = "room_host" if role == "host" else "room_play"
+
+def _reclaim_room():
+    """סשן חדש עם קוד+טוקן ב-URL חוזר לחדר, אם הטוקן עדיין תקף."""
+    code, role, token = (st.query_params.get(k, "") for k in ("room", "role", "rt"))
+    if not (code and token):
+        return
+    room = _get_room_store().get(code)
+    ok = room is not None and (
+        (role == "host" and room["host"] == token) or (role == "player" and token in room["players"])
+    )
+    if ok:
+        _enter_room(code, role, token)
+        st.rerun()  # הכותרת כבר צוירה לפי מסך הפתיחה
+    else:
+        for k in ("room", "role", "rt"):
+            st.query_params.pop(k, None)
+
+def _leave_room():
+    """מארח שעוזב סוגר את החדר - כדי שהשחקנים לא יחכו עד תום ה-TTL."""
+    if st.session_state.get("room_role") == "host" and st.session_state.get("room_code"):
+        _get_room_store().close(st.session_state["room_code"], _room_token())
+    for k in ["room_code", "room_role", "room_token", "room_seen_version"]:
+        st.session_state.pop(k, None)
+    for k in ("room", "role", "rt"):
+        st.query_params.pop(k, None)
+    reset_game_state()
+
+def _room_poller(code: str):
+    """פולינג זול על מונה הגרסה; rerun מלא רק כשהמארח שינה משהו."""
+    v = _get_room_store().version(code)
+    if v != st.session_state.get("room_seen_version"):
+        st.rerun()
+
+def _render_leaderboard(code: str, top: int = 20):
+    rows = _get_room_store().leaderboard(code)
+    st.caption(f"שחקנים בחדר: {len(rows)}")
+    if rows:
+        st.markdown("\n".join(
+            f"{i+1}. **{html.escape(name)}** - {score} נק' ({answered} תשובות)"
+            for i, (name, score, answered) in enumerate(rows[:top])
+        ))
+
+if hasattr(st, "fragment"):
+    _room_poller = st.fragment(run_every=ROOM_POLL_SECONDS)(_room_poller)
+    _live_leaderboard = st.fragment(run_every=ROOM_POLL_SECONDS)(_render_leaderboard)
+else:
+    _live_leaderboard = _render_leaderboard
+
 # ========================= מדיה לתצוגה =========================
 def _render_media(q: Dict[str, Any], key: str):
     t = q.get("type", "text")
     url = q.get("content_url", "")
     if not url:
         return
-    signed = _signed_or_raw(url, seconds=300)
+    rend = q.get("renditions") or {}  # המרות ידידותיות לדפדפן, אם קיימות
+    meta = q.get("media") or {}       # מידות + placeholder שנאספו בהעלאה
+    w, h = meta.get("width"), meta.get("height")
+    ph = meta.get("placeholder", "")
     if t == "image":
-        st.image(signed, use_container_width=True)
+        signed = _signed_or_raw(url, seconds=300)
+        if not signed:
+            st.caption(BUSY_MSG); return
+        if not (w and h and _is_http_url(signed)):
+            # נתיב מקומי - רק st.image מגיש אותו מהשרת
+            st.image(signed, use_container_width=True)
+            return
+        # מקום שמור לפי יחס הגובה-רוחב + placeholder מטושטש עד שהתמונה נטענת
+        bg = f"background-image:url('{html.escape(ph)}');" if ph else ""
+        st.markdown(
+            f'<div class="media-box" style="aspect-ratio:{int(w)}/{int(h)};{bg}">'
+            f'<img src="{html.escape(signed)}" width="{int(w)}" height="{int(h)}" decoding="async" alt=""></div>',
+            unsafe_allow_html=True
+        )
     elif t == "video":
         # וידיאו מושתק בלבד, playsinline, כדי לשמור פרטיות ושקט
+        signed = _signed_or_raw(rend.get("video") or url, seconds=300)
+        if not signed:
+            st.caption(BUSY_MSG); return
+        poster = _signed_or_raw(rend["poster"], seconds=300) if rend.get("poster") else ""
+        poster_attr = f' poster="{html.escape(poster or ph)}"' if (poster or ph) else ""
+        size_attr = f' width="{int(w)}" height="{int(h)}" style="aspect-ratio:{int(w)}/{int(h)};height:auto"' if (w and h) else ""
+        bg = f' style="background-image:url(\'{html.escape(ph)}\')"' if ph else ""
         st.markdown(
             f"""
-            <div class="video-shell">
-              <video muted playsinline controls preload="metadata" src="{html.escape(signed)}"></video>
+            <div class="video-shell"{bg}>
+              <video muted playsinline controls preload="metadata"{poster_attr}{size_attr} src="{html.escape(signed)}"></video>
             </div>
             """,
             unsafe_allow_html=True
         )
     elif t == "audio":
-        st.audio(signed)
+        sources = [(_signed_or_raw(rend[k], seconds=300), mime)
+                   for k, mime in (("audio_opus", "audio/webm"), ("audio_aac", "audio/mp4")) if rend.get(k)]
+        sources = [(u, mime) for u, mime in sources if _is_http_url(u)]
+        if not sources:
+            # מקומי: st.audio מגיש את הקובץ מהשרת - עדיף רנדישן AAC אם קיים
+            signed = _signed_or_raw(rend.get("audio_aac") or url, seconds=300)
+            if not signed:
+                st.caption(BUSY_MSG); return
+            st.audio(signed)
+            return
+        tags = "".join(f'<source src="{html.escape(u)}" type="{mime}">' for u, mime in sources)
+        st.markdown(
+            f'<div class="audio-shell"><audio controls preload="metadata">{tags}</audio></div>',
+            unsafe_allow_html=True
+        )
 
 # ========================= תשובות כ"רדיו-כפתורים" =========================
 def answers_grid(question: Dict[str, Any], q_index: int, key_prefix: str):
@@ -340,6 +1139,8 @@ if not st.session_state.get("admin_mode"):
 # ========================= UI משתמש רגיל =========================
 if not st.session_state.get("admin_mode"):
     all_q = _read_questions_cached()
+    if "room_code" not in st.session_state:
+        _reclaim_room()
     if "phase" not in st.session_state:
         st.session_state.phase = "welcome"
 
@@ -357,6 +1158,21 @@ if not st.session_state.get("admin_mode"):
                 st.rerun()
         st.markdown('</div>', unsafe_allow_html=True)
 
+        st.divider()
+        st.markdown("**משחק קבוצתי (כיתה / אירוע)**")
+        rc1, rc2 = st.columns(2)
+        if rc1.button("פתח חדר (מארח)"):
+            deck = _draw_deck()
+            if not deck:
+                st.warning("אין שאלות במאגר כרגע.")
+            else:
+                token = uuid.uuid4().hex
+                _enter_room(_get_room_store().create(token, deck), "host", token)
+                st.rerun()
+        if rc2.button("הצטרף לחדר"):
+            st.session_state.phase = "room_join"
+            st.rerun()
+
     elif st.session_state.phase == "quiz":
         if not all_q or "questions" not in st.session_state:
             st.info("אין שאלות כרגע.")
@@ -467,17 +1283,133 @@ if not st.session_state.get("admin_mode"):
             st.session_state.phase = "welcome"
             st.rerun()
 
+    elif st.session_state.phase == "room_join":
+        st.subheader("הצטרפות לחדר")
+        code = st.text_input("קוד חדר", max_chars=5, key="join_code").strip().upper()
+        name = st.text_input("כינוי (יוצג בטבלת המובילים)", max_chars=24, key="join_name").strip()
+        c1, c2 = st.columns(2)
+        if c1.button("הצטרף", disabled=not (code and name)):
+            token = uuid.uuid4().hex
+            if _get_room_store().join(code, token, name):
+                _enter_room(code, "player", token)
+            else:
+                flash("error", "החדר לא נמצא, מלא או שהסתיים")
+            st.rerun()
+        if c2.button("חזרה"):
+            st.session_state.phase = "welcome"
+            st.rerun()
+
+    elif st.session_state.phase == "room_host":
+        store = _get_room_store()
+        code = st.session_state.get("room_code", "")
+        room = store.get(code)
+        if room is None or room["host"] != _room_token():
+            st.error("החדר לא נמצא")
+            if st.button("חזור למסך הבית"):
+                _leave_room(); st.session_state.phase = "welcome"; st.rerun()
+        else:
+            st.subheader("חדר מארח")
+            st.markdown(f"<h1 style='font-size:48px;text-align:center;letter-spacing:6px'>{html.escape(code)}</h1>",
+                        unsafe_allow_html=True)
+            st.caption("השחקנים נכנסים עם הקוד דרך \"הצטרף לחדר\".")
+            deck = room["deck"]; idx = room["current_idx"]
+
+            if room["status"] == "lobby":
+                st.info(f"ממתינים לשחקנים... {len(deck)} שאלות בחפיסה")
+                c1, c2 = st.columns(2)
+                if c1.button("התחל משחק"):
+                    store.advance(code, _room_token()); st.rerun()
+                if c2.button("סגור חדר"):
+                    _leave_room(); st.session_state.phase = "welcome"; st.rerun()
+            elif room["status"] == "question":
+                q = deck[idx]
+                st.write(f"שאלה {idx+1} מתוך {len(deck)}")
+                _render_media(q, key=f"host{idx}")
+                st.markdown(f"### {q['question']}")
+                last = (idx + 1 >= len(deck))
+                c1, c2 = st.columns(2)
+                if c1.button("סיים משחק" if last else "שאלה הבאה"):
+                    store.advance(code, _room_token()); st.rerun()
+                if c2.button("סגור חדר"):
+                    store.close(code, _room_token()); st.rerun()
+            else:
+                st.success("המשחק הסתיים")
+
+            st.divider()
+            st.markdown("### טבלת המובילים")
+            if room["status"] == "ended":
+                _render_leaderboard(code)
+                if st.button("חזור למסך הבית"):
+                    _leave_room(); st.session_state.phase = "welcome"; st.rerun()
+            else:
+                _live_leaderboard(code)
+
+    elif st.session_state.phase == "room_play":
+        store = _get_room_store()
+        code = st.session_state.get("room_code", "")
+        room = store.get(code)
+        if room is None:
+            st.error("החדר נסגר או לא קיים")
+            if st.button("חזור למסך הבית"):
+                _leave_room(); st.session_state.phase = "welcome"; st.rerun()
+        else:
+            ensure_game_loaded(deck=room["deck"])  # אותה חפיסה לכל השחקנים
+            st.session_state["room_seen_version"] = room["version"]
+            me = room["players"].get(_room_token()) or {"answers": {}, "score": 0}
+            st.caption(f"חדר {code}")
+
+            if room["status"] == "lobby":
+                st.info("ממתינים שהמארח יתחיל...")
+            elif room["status"] == "question":
+                idx = room["current_idx"]
+                q = st.session_state.questions[idx]
+                st.write(f"שאלה {idx+1} מתוך {len(st.session_state.questions)}")
+                _render_media(q, key=f"room{idx}")
+                st.markdown(f"### {q['question']}")
+                picked = me["answers"].get(str(idx))
+                if picked is not None:
+                    st.info(f"נשלח: **{html.escape(picked)}** - ממתינים לשאלה הבאה")
+                else:
+                    cols = st.columns(2)
+                    for i, a in enumerate(q["answers"]):
+                        if cols[i % 2].button(a["text"], key=f"room_ans_{code}_{idx}_{i}", use_container_width=True):
+                            if not store.answer(code, _room_token(), idx, a["text"]):
+                                flash("warning", "השאלה כבר נסגרה")
+                            st.rerun()
+            else:
+                st.subheader("המשחק הסתיים")
+                st.markdown(f"<h1 style='font-size:48px;text-align:center;'>{me['score']}</h1>", unsafe_allow_html=True)
+                _render_leaderboard(code, top=10)
+
+            if room["status"] != "ended":
+                _room_poller(code)
+            if st.button("עזוב חדר"):
+                _leave_room(); st.session_state.phase = "welcome"; st.rerun()
+
 # ========================= ממשק אדמין =========================
 def admin_login_ui():
     st.subheader("כניסת מנהלים")
     code = st.text_input("קוד מנהל", type="password")
     cols = st.columns(2)
     if cols[0].button("היכנס"):
-        if code == ADMIN_CODE:
+        # כישלונות נספרים לפי כתובת הלקוח (לא לפי סשן) ונבדקים בכל ניסיון;
+        # המגבלה הגלובלית חלה על כולם חוץ מ-ADMIN_ALLOW_ADDRS
+        addr = _client_addr()
+        limiter = _get_limiter()
+        if (not _rate_ok("login")
+                or limiter.penalty_left(addr) > 0
+                or not limiter.has_tokens(addr, "login_fail")
+                or (addr not in ADMIN_ALLOW_ADDRS and not limiter.has_tokens("*", "login_fail_global"))):
+            flash("error", "יותר מדי ניסיונות. נסו שוב בעוד מספר שניות."); st.rerun()
+        elif code == ADMIN_CODE:
+            limiter.forgive(addr)
             st.session_state["admin_screen"] = "menu"
             st.session_state["is_admin"] = True
             flash("success", "התחברת בהצלחה"); st.rerun()
         else:
+            limiter.penalize(addr, LOGIN_BACKOFF_MAX_SECONDS)
+            limiter.allow(addr, "login_fail")
+            limiter.allow("*", "login_fail_global")
             flash("error", "קוד שגוי"); st.rerun()
     if cols[1].button("חזרה"):
         reset_admin_state(); st.rerun()
@@ -525,6 +1457,8 @@ def admin_edit_detail_ui():
     _render_media(q, key=f"adm_{qid}")
     st.markdown(f"### {q['question']}")
     st.caption(f"קטגוריה: {q.get('category','')} | קושי: {q.get('difficulty','')}")
+    if _media_summary(q):
+        st.caption(f"מדיה: {_media_summary(q)}")
 
     col1, col2 = st.columns(2)
     ans = q["answers"]
@@ -552,6 +1486,7 @@ def admin_edit_detail_ui():
 
     if colC.button("שמור", disabled=not st.session_state.get("admin_edit_mode", False)):
         try:
+            _require_rate("write")
             new_q = dict(q)
             new_q["question"]   = st.session_state.get("edit_q_text", q["question"])
             new_q["category"]   = st.session_state.get("edit_q_cat", q.get("category", ""))
@@ -568,16 +1503,29 @@ def admin_edit_detail_ui():
 
             new_q["type"] = st.session_state.get("edit_q_type", q.get("type", "text"))
             new_q["content_url"] = st.session_state.get("edit_q_media_url", q.get("content_url", ""))
+            url_changed = new_q["content_url"] != q.get("content_url", "")
 
-            all_q = _read_questions_cached()
-            for i, row in enumerate(all_q):
-                if row.get("id") == qid:
-                    all_q[i] = new_q
-                    break
-            _write_questions(all_q)
+            with _bank_write():
+                all_q = _read_questions_cached()
+                for i, row in enumerate(all_q):
+                    if row.get("id") == qid:
+                        # רנדישנים ומטא-דאטה נבדקים בתוך הנעילה - עבודת רקע אולי עדכנה אותם בינתיים
+                        if url_changed:
+                            new_q["renditions"] = _renditions_for(new_q["content_url"])
+                            new_q["media"] = _media_meta_for(new_q["content_url"])
+                        else:
+                            for field in ("renditions", "media"):
+                                if field in row:
+                                    new_q[field] = row[field]
+                        all_q[i] = new_q
+                        break
+                _write_questions(all_q)
             st.session_state["admin_edit_mode"] = False
             flash("success", "עדכון בוצע בהצלחה")
             st.rerun()
+        except BusyError as e:
+            flash("warning", str(e))
+            st.rerun()
         except Exception:
             flash("error", "שמירה נכשלה. בדוק הרשאות/חיבור ל-Supabase ונסה שוב.")
             st.rerun()
@@ -619,10 +1567,12 @@ def admin_edit_detail_ui():
         if up is None:
             st.session_state.pop("edit_upload_done", None)
         elif not st.session_state.get("edit_upload_done"):
-            saved = _save_uploaded_to_storage(up)
-            st.session_state["edit_q_media_url"] = saved
-            st.session_state["edit_upload_done"] = True
-            flash("success", "קובץ הוחלף בהצלחה")
+            st.session_state["edit_upload_done"] = True  # גם כשעמוס - לא מנסים שוב בכל rerun
+            try:
+                st.session_state["edit_q_media_url"] = _save_uploaded_to_storage(up)
+                flash("success", "קובץ הוחלף בהצלחה")
+            except BusyError as e:
+                flash("warning", str(e))
             st.rerun()
 
         # שליטה בלעדית של הווידג'ט בערך
@@ -657,14 +1607,20 @@ def admin_delete_list_ui():
                 checked_ids.append(q["id"])
         with cols[1]:
             st.markdown(f"**{q['question'][:110]}**")
-            st.caption(f"id: {q['id']} | קטגוריה: {q.get('category','')} | קושי: {q.get('difficulty','')}")
+            summary = _media_summary(q)
+            st.caption(f"id: {q['id']} | קטגוריה: {q.get('category','')} | קושי: {q.get('difficulty','')}"
+                       + (f" | מדיה: {summary}" if summary else ""))
         st.divider()
     c1, c2, c3 = st.columns(3)
     if c1.button("מחק") and checked_ids:
-        new_list = [x for x in all_q if x.get("id") not in checked_ids]
-        _write_questions(new_list)
-        st.session_state["admin_screen"] = "menu"
-        flash("success", "תוכן נמחק בהצלחה")
+        try:
+            _require_rate("write")
+            with _bank_write():  # קריאה טרייה - לא לדרוס שינויים שנכתבו מאז שהרשימה הוצגה
+                _write_questions([x for x in _read_questions_cached() if x.get("id") not in checked_ids])
+            st.session_state["admin_screen"] = "menu"
+            flash("success", "תוכן נמחק בהצלחה")
+        except BusyError as e:
+            flash("warning", str(e))
         st.rerun()
     if c2.button("רענן"): st.rerun()
     if c3.button("חזרה"):
@@ -685,10 +1641,12 @@ def admin_add_form_ui():
         if up is None:
             st.session_state.pop("add_upload_done", None)
         elif not st.session_state.get("add_upload_done"):
-            saved = _save_uploaded_to_storage(up)
-            st.session_state["add_media_url"] = saved
-            st.session_state["add_upload_done"] = True
-            flash("success", "קובץ נשמר בהצלחה")
+            st.session_state["add_upload_done"] = True  # גם כשעמוס - לא מנסים שוב בכל rerun
+            try:
+                st.session_state["add_media_url"] = _save_uploaded_to_storage(up)
+                flash("success", "קובץ נשמר בהצלחה")
+            except BusyError as e:
+                flash("warning", str(e))
             st.rerun()
 
         st.text_input("או הדבק URL", key="add_media_url")
@@ -726,7 +1684,7 @@ def admin_add_form_ui():
             flash("warning", "לשאלת מדיה חובה לצרף קובץ או URL"); st.rerun()
         else:
             try:
-                all_q = _read_questions_cached()
+                _require_rate("write")
                 new_item = {
                     "id": uuid.uuid4().hex,
                     "type": t,
@@ -737,11 +1695,19 @@ def admin_add_form_ui():
                     "difficulty": difficulty,
                     "created_at": datetime.utcnow().isoformat()
                 }
-                all_q.append(new_item)
-                _write_questions(all_q)
+                with _bank_write():
+                    if new_item["content_url"]:
+                        new_item["renditions"] = _renditions_for(new_item["content_url"])
+                        new_item["media"] = _media_meta_for(new_item["content_url"])
+                    all_q = _read_questions_cached()
+                    all_q.append(new_item)
+                    _write_questions(all_q)
                 st.session_state["admin_screen"] = "menu"
                 flash("success", "תוכן נוסף בהצלחה")
                 st.rerun()
+            except BusyError as e:
+                flash("warning", str(e))
+                st.rerun()
             except Exception:
                 flash("error", "שמירה נכשלה. בדוק הרשאות/חיבור ל-Supabase ונסה שוב.")
                 st.rerun()